@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding: utf-8
 """
 file: 'parse.py'
@@ -24,33 +24,60 @@ description:
     The former file contains names of files which couldn't be read using
     the 'backscatter' library, as well as the exceptions they threw.
 
+    If the SUPERDARN_PARSE_CACHE_DIR environment variable names a folder, 
+    the records parsed from each (problem-free) file are kept there so that
+    re-runs can skip re-parsing them. It isn't pruned, but it's safe to 
+    delete.
+
 author: David Fairbairn
 date: July 6 2017
 """
 
 import logging
 import os
+import subprocess
 
 from datetime import datetime as dt
-import numpy as np
-import sqlite3
 import argparse
 import time
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import shutil
+import hashlib
+import pickle
 import itertools
+from contextlib import closing
+from os import scandir
 
 import backscatter 
 import rawacf_utils as rut
-from rawacf_utils import two_pad
 
 SUBPROC_JOIN_TIMEOUT = 15
 SHORT_SLEEP_INTERVAL = 0.1
+# Files a pool worker handles before being replaced (bounds its memory growth)
+POOL_MAXTASKSPERCHILD = 50
+# Upper limit on pool workers, and how many files are handed to one at a time
+POOL_MAX_PROCESSES = 8
+POOL_CHUNKSIZE = 16
+# Number of parsed records to accumulate before inserting them into the DB
+DB_BATCH_SIZE = 500
+# How many windows of days are fetched ahead of the one being parsed, and
+# the most Globus transfers to have going at once (to go easy on the server)
+FETCH_AHEAD = 1
+MAX_CONCURRENT_FETCHES = int(os.environ.get('SUPERDARN_MAX_CONCURRENT_FETCH', 4))
+
+# Folder for caching parsed records between runs (off unless it's given)
+PARSE_CACHE_DIR = os.environ.get('SUPERDARN_PARSE_CACHE_DIR')
+PARSE_CACHE_HASH_BYTES = 65536
 
 BAD_RAWACFS_FILE = './bad_rawacfs.txt'
 INCONSISTENT_FIELDS_FILE = './bad_fields.txt'
 LOG_FILE = 'parse.log'
 
-logging.basicConfig(level=logging.DEBUG,
+# Functions for reading dmap records, keyed by the file extension they handle
+DMAP_READERS = {'.bz2': rut.bz2_dic, '.rawacf': rut.acf_dic}
+
+logging.basicConfig(level=logging.INFO,
     format='%(levelname)s %(asctime)s: %(message)s', 
     datefmt='%m/%d/%Y %I:%M:%S %p')
 
@@ -79,50 +106,51 @@ def process_rawacfs_day(year, month, day, station_code=None, conn=None):
             know of a really quick and easy way to convert stid's and station codes
             without requiring an installation of e.g. davitpy **
     """
-    import subprocess
-    import calendar 
-
-    if conn==None:
-        conn = sqlite3.connect("superdarntimes.sqlite")
-
-    # If a stid is given to function, then just grab that station's stuff
-    all_stids = True if station_code is None else False
+    own_conn = conn is None
+    if own_conn:
+        conn = rut.connect_db()
+    try:
+        # If a stid is given to function, then just grab that station's stuff
+        all_stids = True if station_code is None else False
 
-    # I. Run the globus connect process
-    rut.globus_connect()
+        # I. Run the globus connect process
+        rut.globus_connect()
 
-    # II. Fetch the files
-    if all_stids:
-        script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
-            str(month), '-p', str(year)+"{:02d}".format(month)+"{:02d}".format(day)+"*", rut.ENDPOINT]
-    else:
-        # The case that we're looking at just one particular station
-        script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
-            str(month), '-p', str(year)+"{:02d}".format(month)+"{:02d}".format(day)+"*"+station_code, 
-            rut.ENDPOINT]
-    rut.globus_query(script_query)
+        # II. Fetch the files
+        date_str = "{0:04d}{1:02d}{2:02d}".format(year, month, day)
+        if all_stids:
+            script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
+                str(month), '-p', date_str+"*", rut.ENDPOINT]
+        else:
+            # The case that we're looking at just one particular station
+            script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
+                str(month), '-p', date_str+"*"+station_code, 
+                rut.ENDPOINT]
+        rut.globus_query(script_query)
 
-    # III.
-    # B. Parse the rawacf files, save their metadata in our DB
-    parse_rawacf_folder(rut.ENDPOINT, conn=conn)
-    logging.info("\t\tDone with parsing {0}-{1}-{2} rawacf data".format(
-                 str(year), "{:02d}".format(month), "{:02d}".format(day)))
-    conn.commit()
+        # III.
+        # B. Parse the rawacf files, save their metadata in our DB
+        parse_rawacf_folder(rut.ENDPOINT, conn=conn)
+        logging.info("\t\tDone with parsing %04d-%02d-%02d rawacf data", year, month, day)
 
-    # C. Clear the rawacf files that were fetched in this cycle
-    try:
-        rut.clear_endpoint()
-        logging.info("\t\tDone with clearing {0}-{1}-{2} rawacf data".format(
-                 str(year), "{:02d}".format(month), "{:02d}".format(day)))
-    except subprocess.CalledProcessError:
-        logging.error("\t\tUnable to remove files.", exc_info=True)
-    logging.info("Completed processing of requested day's rawacf data.")
+        # C. Clear the rawacf files that were fetched in this cycle
+        try:
+            rut.clear_endpoint()
+            logging.info("\t\tDone with clearing %04d-%02d-%02d rawacf data", year, month, day)
+        except subprocess.CalledProcessError:
+            logging.error("\t\tUnable to remove files.", exc_info=True)
+        logging.info("Completed processing of requested day's rawacf data.")
+    finally:
+        # Only close the connection if it was opened here
+        if own_conn:
+            conn.close()
  
-def process_rawacfs_month(year, month, conn=sqlite3.connect("superdarntimes.sqlite"),
+def process_rawacfs_month(year, month, conn=None,
                          multiprocess=True, days=[]):
     """
     Takes starting month and year and ending month and year as arguments. Steps
-    through each day in each year/month combo
+    through the days in each year/month combo, a window of days at a time
+    (see fetch_windows)
 
     :param year: [int] indicating the year to look at
     :param month: [int] indicating the month to look at
@@ -133,54 +161,117 @@ def process_rawacfs_month(year, month, conn=sqlite3.connect("superdarntimes.sqli
     ** On Maxwell this has taken upwards of 14 hours to run for a given month **
 
     """
-    import subprocess
-    import calendar 
-
-    last_day = calendar.monthrange(year, month)[1]
-    if type(days)==list and len(days) > 0: 
-        cond1 = all([ type(d)==int for d in days])
-        cond2 = all([ d in np.arange(1,last_day+1)])
-        if cond1 and cond2:
-            # Only now has the custom days range been fully validated
-            days_list = days
-    else:
-        days_list = np.arange(1,last_day+1)
-
-    # I. Run the globus connect process
-    rut.globus_connect()
-
-    logging.info("Beginning to process Rawacf logs... ")
+    own_conn = conn is None
+    if own_conn:
+        conn = rut.connect_db()
+    try:
+        last_day = rut.days_in_month(year, month)
+        days_list = range(1, last_day+1)
+        if type(days)==list and len(days) > 0: 
+            cond1 = all([ type(d)==int for d in days])
+            cond2 = cond1 and all([ 1 <= d <= last_day for d in days])
+            if cond1 and cond2:
+                # Only now has the custom days range been fully validated
+                days_list = days
+            else:
+                logging.error("Invalid days given: {0}. Doing the whole month.".format(days))
+
+        # I. Run the globus connect process
+        rut.globus_connect()
+
+        logging.info("Beginning to process Rawacf logs... ")
     
-    logging.info("Starting to analyze {0}-{1} files...".format(str(year), "{:02d}".format(month))) 
-
-    # II. For each day in the month:
-    for day in days_list:
-        logging.info("\tLooking at {0}-{1}-{2}".format(
-                     str(year), "{:02d}".format(month), "{:02d}".format(day)))
+        logging.info("Starting to analyze %s-%02d files...", year, month)
+
+        # II. For each window of days in the month. The Globus transfers run in
+        # background threads, FETCH_AHEAD windows ahead of the one being parsed,
+        # so the parsing isn't left waiting on the network. No more than 
+        # MAX_CONCURRENT_FETCHES transfers are ever in flight at once
+        windows = fetch_windows(year, month, days_list)
+        fetches = [None]*len(windows)
+        with closing(ThreadPool(processes=MAX_CONCURRENT_FETCHES)) as fetcher:
+            for k, (window_days, patterns) in enumerate(windows):
+                window_str = "{0:04d}-{1:02d}-{2:02d} to {3:02d}".format(year, month,
+                             window_days[0], window_days[-1])
+                logging.info("\tLooking at %s", window_str)
+
+                # A. Make sure this window's (and the next few's) rawacfs are 
+                # being fetched, then wait on this window's
+                for ahead in range(k, min(k + FETCH_AHEAD + 1, len(windows))):
+                    if fetches[ahead] is None:
+                        ahead_days, ahead_patterns = windows[ahead]
+                        folder = "{0}/{1:04d}{2:02d}{3:02d}".format(rut.ENDPOINT, year,
+                                  month, ahead_days[0])
+                        if not os.path.isdir(folder):
+                            os.makedirs(folder)
+                        transfers = [fetcher.apply_async(fetch_rawacfs, (year, month, p, folder))
+                                     for p in ahead_patterns]
+                        fetches[ahead] = (folder, transfers)
+                folder, transfers = fetches[k]
+                for transfer in transfers:
+                    transfer.get()
+
+                # B. Parse the rawacf files, save their metadata in our DB
+                parse_rawacf_folder(folder, conn=conn, multiprocess=multiprocess)
+                logging.info("\t\tDone with parsing %s rawacf data", window_str)
+
+                # C. Clear the rawacf files that were fetched in this cycle
+                try:
+                    shutil.rmtree(folder)
+                    logging.info("\t\tDone with clearing %s rawacf data", window_str)
+                except OSError:
+                    logging.error("\t\tUnable to remove files.", exc_info=True)
+
+        logging.info("Completed processing of requested month's rawacf data.")
+        return
+    finally:
+        if own_conn:
+            conn.close()
+        
+def fetch_rawacfs(year, month, pattern, folder):
+    """
+    Fetches the rawacfs matching a filename pattern into a folder via
+    Globus, waiting until they've arrived.
 
-        # A. First, grab the rawacfs via globus (and wait on it)
-        script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
-            str(month), '-p', str(year)+"{:02d}".format(month)+"{:02d}".format(day)+"*", rut.ENDPOINT]
+    :param year: [int] indicating the year to look at
+    :param month: [int] indicating the month to look at
+    :param pattern: [str] filename pattern (see fetch_windows)
+    :param folder: [str] path of an existing folder to put the rawacfs in
+    """
+    script_query = [rut.SYNC_SCRIPT_LOC,'-y', str(year), '-m',
+        str(month), '-p', pattern, folder]
+    rut.globus_query(script_query)
 
-        rut.globus_query(script_query)
+def fetch_windows(year, month, days):
+    """
+    Groups the days of a month into windows whose rawacfs can be fetched 
+    together, so that Globus' per-transfer setup is paid a few times a month
+    rather than every day. Days 1-9, 10-19, 20-29 and 30-31 each share a 
+    filename pattern (e.g. '2016011*'); a window that's only partly wanted
+    gets one pattern per wanted day instead.
 
-        # B. Parse the rawacf files, save their metadata in our DB
-        parse_rawacf_folder(rut.ENDPOINT, conn=conn, multiprocess=multiprocess)
-        logging.info("\t\tDone with parsing {0}-{1}-{2} rawacf data".format(
-                     str(year), "{:02d}".format(month), "{:02d}".format(day)))
+    :param year: [int] indicating the year to look at
+    :param month: [int] indicating the month to look at
+    :param days: the days of the month that are wanted
 
-        # C. Clear the rawacf files that were fetched in this cycle
-        try:
-            rut.clear_endpoint()
-            logging.info("\t\tDone with clearing {0}-{1}-{2} rawacf data".format(
-                     str(year), "{:02d}".format(month), "{:02d}".format(day)))
-        except subprocess.CalledProcessError:
-            logging.error("\t\tUnable to remove files.", exc_info=True)
+    :returns: [list] of ([list] of days, [list] of filename patterns) tuples
+    """
+    last_day = rut.days_in_month(year, month)
+    month_str = "{0:04d}{1:02d}".format(year, month)
+    windows = []
+    for tens in range(last_day//10 + 1):
+        window = list(range(max(1, 10*tens), min(10*tens + 9, last_day) + 1))
+        wanted = [d for d in window if d in days]
+        if len(wanted) == 0:
+            continue
+        if wanted == window:
+            patterns = [month_str + str(tens) + "*"]
+        else:
+            patterns = [month_str + "{:02d}".format(d) + "*" for d in wanted]
+        windows.append((wanted, patterns))
+    return windows
 
-    logging.info("Completed processing of requested month's rawacf data.")
-    return
-        
-def process_file(fname, conn=sqlite3.connect("superdarntimes.sqlite")):
+def process_file(fname, conn=None):
     """
     Essentially a wrapper for using parse_file that handles some possible 
     exceptions. This function is only used if you call the script to just
@@ -188,35 +279,42 @@ def process_file(fname, conn=sqlite3.connect("superdarntimes.sqlite")):
     
     :param f: file name including path.
     """
-    # Start exception handler/write handler
-    manager = mp.Manager()
-    exc_msg_queue = manager.Queue()
-    write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
-    write_handler.start()
+    own_conn = conn is None
+    if own_conn:
+        conn = rut.connect_db()
     try:
-        dummy_index = 1
-        path = os.path.dirname(fname)
-        fil = os.path.basename(fname)
-        r = parse_file(path, fil, dummy_index, exc_msg_queue)
-
-    except backscatter.dmap.DmapDataError as e:
-        # TODO: Test whether this condition is ever tripped - 'parse_file' should handle this for every case
-        err_str = "\t{0} File: {1}: Error reading dmap from stream - possible record" + \
-                  " corruption. Skipping file."
-        logging.error(err_str.format(index, fname), exc_info=True)
-        return
-
-    except rut.InconsistentRawacfError as e:
-        err_str = "\t{0} File {1}: Exception raised during process_experiment: {2}"
-        logging.warning(err_str.format(index, fname, e))
-    write_handler.terminate()
-    curr = conn.cursor()
-    r.save_to_db(curr)
-    conn.commit() 
-    return r
+        # Start exception handler/write handler
+        manager = mp.Manager()
+        exc_msg_queue = manager.Queue()
+        write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
+        write_handler.start()
+        try:
+            dummy_index = 1
+            path = os.path.dirname(fname)
+            fil = os.path.basename(fname)
+            r = parse_file(path, fil, dummy_index, exc_msg_queue)
+
+        except backscatter.dmap.DmapDataError as e:
+            # TODO: Test whether this condition is ever tripped - 'parse_file' should handle this for every case
+            err_str = "\t{0} File: {1}: Error reading dmap from stream - possible record" + \
+                      " corruption. Skipping file."
+            logging.error(err_str.format(index, fname), exc_info=True)
+            return
 
-def parse_rawacf_folder(folder, conn=sqlite3.connect("superdarntimes.sqlite"), 
-                        multiprocess=False):
+        except rut.InconsistentRawacfError as e:
+            err_str = "\t{0} File {1}: Exception raised during process_experiment: {2}"
+            logging.warning(err_str.format(index, fname, e))
+        stop_exc_handler(exc_msg_queue, write_handler)
+        curr = conn.cursor()
+        r.save_to_db(curr)
+        conn.commit() 
+        return r
+    finally:
+        if own_conn:
+            conn.close()
+
+def parse_rawacf_folder(folder, conn=None, 
+                        multiprocess=False, bulk_load=True):
     """
     Takes a path to a folder which contains of .rawacf files, parses them
     and inserts them into the database.
@@ -225,63 +323,126 @@ def parse_rawacf_folder(folder, conn=sqlite3.connect("superdarntimes.sqlite"),
                     rawacf files from
     :param conn: [sqlite3 connection] to the database
     :param multiprocess: [Boolean] whether or not to use a multiprocessing pool
+    :param bulk_load: [Boolean] whether to skip syncing to disk while saving
+                        (see save_records)
     """
-    from contextlib import closing
     assert(os.path.isdir(folder))
-    cur = conn.cursor()
-    logging.info("Acceptable path {0}. Analysis proceeding...".format(folder))
-
-    processes = []
+    logging.info("Acceptable path %s. Analysis proceeding...", folder)
+    own_conn = conn is None
+    if own_conn:
+        conn = rut.connect_db()
+    try:
+        processes = []
 
-    # Start exception handler/write handler
-    manager = mp.Manager()
-    exc_msg_queue = manager.Queue()
-    write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
-    write_handler.start()  
+        # Start exception handler/write handler
+        manager = mp.Manager()
+        exc_msg_queue = manager.Queue()
+        write_handler = mp.Process(target=exc_handler_func, args=( exc_msg_queue,))
+        write_handler.start()  
     
-    files = os.listdir(folder) 
-    file_indices = np.arange(1, len(files)+1) 
-    # Perform this task differently depending on if we're willing to multiprocess
-    if multiprocess==True:
-        # Assemble a bundle of arguments for mp.pool to use 
-        arg_bundle = itertools.izip(itertools.repeat(folder), files, file_indices,
-                    itertools.repeat(exc_msg_queue))
-      
-        # Set the pool to work
-        logging.debug("Beginning a pool multiprocessing of the files...") 
+        # Only hang onto the files that there's a dmap reader for. The directory
+        # entries from scandir already know whether they're regular files, so no
+        # extra stat is needed per file
+        files = sorted(entry.name for entry in scandir(folder) if entry.is_file() and 
+                       os.path.splitext(entry.name)[1] in DMAP_READERS)
+        logging.info("Found %d rawacf files to parse", len(files))
+        file_indices = range(1, len(files)+1) 
+        # Perform this task differently depending on if we're willing to multiprocess
+        if multiprocess==True:
+            # Set the pool to work
+            logging.debug("Beginning a pool multiprocessing of the files...") 
         
-        try:
-            # Force python to garbage collect by using closing from context lib?
-            with closing(mp.Pool(maxtasksperchild=2)) as pool:
-                recs = pool.map(parse_file_wrapper, arg_bundle)
-            logging.debug("Done with multiprocessing of files (supposedly)")
-        except Exception as e:
-            logging.error("\nUnsuccessful multiprocessing attempt. Continuing sequentially\n")
-            logging.exception(e)
-            multiprocess = False 
-    if multiprocess==False:
-        # Sequential processing: iterate through, parsing each file 1-by-1
-        recs = []
-        for i, fil in enumerate(files):
-            path = rut.ENDPOINT
-            fname = os.path.basename(fil)
-            r = parse_file(path, fname, i, exc_msg_queue)
-            recs.append(r)
-    num_uncounted = 0
-    for rec in recs:
-        if rec is not None:
-            rec.save_to_db(cur)
-            conn.commit()
-        else:
-            num_uncounted += 1
-            logging.debug("Found an instance of a None record!")
+            try:
+                # Assemble a bundle of arguments for mp.pool to use 
+                arg_bundle = zip(itertools.repeat(folder), files, file_indices,
+                            itertools.repeat(exc_msg_queue))
+                # Force python to garbage collect by using closing from context lib?
+                num_procs = min(mp.cpu_count(), POOL_MAX_PROCESSES)
+                with closing(mp.Pool(processes=num_procs,
+                                     maxtasksperchild=POOL_MAXTASKSPERCHILD)) as pool:
+                    # The workers parse the files and hand back database rows, 
+                    # which are saved here (sqlite wants a single writer) as 
+                    # they arrive, overlapping with the parsing of later files
+                    rows = pool.imap_unordered(parse_file_wrapper, arg_bundle,
+                                               chunksize=POOL_CHUNKSIZE)
+                    num_saved = save_records(rows, conn, bulk_load)
+                logging.debug("Done with multiprocessing of files (supposedly)")
+            except Exception as e:
+                logging.error("\nUnsuccessful multiprocessing attempt. Continuing sequentially\n")
+                logging.exception(e)
+                multiprocess = False 
+        if multiprocess==False:
+            # Sequential processing: iterate through, parsing each file 1-by-1
+            arg_bundle = zip(itertools.repeat(folder), files, file_indices,
+                        itertools.repeat(exc_msg_queue))
+            rows = (parse_file_wrapper(args) for args in arg_bundle)
+            num_saved = save_records(rows, conn, bulk_load)
+
+        stop_exc_handler(exc_msg_queue, write_handler)
+
+        done_str = "Done with processing files in folder. %d / %d were saved to the database."
+        logging.info(done_str, num_saved, len(files))
+    finally:
+        if own_conn:
+            conn.close()
+
+def save_records(rows, conn, bulk_load=False):
+    """
+    Saves records' rows to the database as they're produced, inserting them
+    in batches of DB_BATCH_SIZE, and commits once they've all been saved.
+    Everything happens inside one explicit transaction; otherwise each 
+    batch's savepoint (see rut.insert_rows) would be committed on its own.
 
-    write_handler.terminate() 
+    :param rows: iterable of database rows from RawacfRecord.as_tuple() (None
+                entries, from files that couldn't be parsed, are skipped)
+    :param conn: [sqlite3 connection] to the database
+    [:param bulk_load:] [Boolean] if True, sqlite doesn't sync to disk until
+                        the records are saved (the connection's usual 
+                        'NORMAL' syncing is restored afterwards). A crash 
+                        meanwhile could lose the records, but they can be
+                        parsed again from the rawacfs.
 
-    done_str = "Done with processing files in folder. {0} / {1} were saved to the database."
-    logging.info(done_str.format(len(files) - num_uncounted, len(files))) 
-    # Commit the database changes
-    conn.commit()
+    :returns: [int] number of records that were handed to the database
+    """
+    cur = conn.cursor()
+    # (sqlite won't change the safety level inside a transaction, so syncing
+    # is only relaxed here if this function gets to start the transaction)
+    own_transaction = not conn.in_transaction
+    relax_sync = bulk_load and own_transaction
+    if relax_sync:
+        cur.execute('PRAGMA synchronous=OFF')
+    try:
+        if own_transaction:
+            cur.execute('BEGIN IMMEDIATE')
+        num_saved = 0
+        batch = []
+        for row in rows:
+            if row is None:
+                logging.debug("Found an instance of a None record!")
+                continue
+            batch.append(row)
+            if len(batch) >= DB_BATCH_SIZE:
+                rut.insert_rows(batch, cur)
+                num_saved += len(batch)
+                batch = []
+        rut.insert_rows(batch, cur)
+        num_saved += len(batch)
+        # Commit the database changes
+        conn.commit()
+        if bulk_load:
+            # Let sqlite refresh its query planner statistics (if they've 
+            # gone stale) now that a lot of entries have gone in at once
+            cur.execute('PRAGMA optimize')
+    except Exception:
+        # Leave the connection usable (e.g. for a retry) rather than stuck
+        # in a half-finished transaction
+        if own_transaction and conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        if relax_sync and not conn.in_transaction:
+            cur.execute('PRAGMA synchronous=NORMAL')
+    return num_saved
 
 def parse_file(path, fname, index, exc_msg_queue):
     """
@@ -302,27 +463,25 @@ def parse_file(path, fname, index, exc_msg_queue):
             normally and the pool can fail or lock up.
     """
     # I. Open File / Read with Backscatter
-    logging.info("{0} File: {1}".format(index, fname)) 
+    # Logged lazily (%-style), since this happens for every file
+    logging.info("%s File: %s", index, fname)
+    reader = DMAP_READERS.get(os.path.splitext(fname)[1])
+    if reader is None:
+        logging.info('\t%s File %s not used for dmap records.', index, fname)
+        return None
     try:
-        if fname[-4:] == '.bz2':
-            dics = rut.bz2_dic(path + '/' + fname)
-        elif fname[-7:] == '.rawacf':
-            dics = rut.acf_dic(path + '/' + fname)
-        else:
-            logging.info('\t{0} File {1} not used for dmap records.'.format(index, fname))
-            return None
+        dics = reader(path + '/' + fname)
     except Exception as e:
-        err_str = "\t{0} File: {1}: Error reading dmap from stream - possible record" + \
+        err_str = "\t%s File: %s: Error reading dmap from stream - possible record" + \
                   " corruption. Skipping file."
-        logging.error(err_str.format(index, fname), exc_info=True)
+        logging.error(err_str, index, fname, exc_info=True)
         # Tell the write handler to add this to the list of bad rawacf files
         exc_msg_queue.put((fname, e))
         return None
     except MemoryError as e:
-        logging.error("\t{0} File: {1}: RAN OUT OF MEMORY.".format(index, fname), exc_info=True)
+        logging.error("\t%s File: %s: RAN OUT OF MEMORY.", index, fname, exc_info=True)
         exc_msg_queue.put((fname, e))
         # 'Just do it again!'. I know its inelegant, but this occurs rarely...
-        import time
         time.sleep(SHORT_SLEEP_INTERVAL)
         return parse_file(path, fname, index, exc_msg_queue)
 
@@ -330,13 +489,13 @@ def parse_file(path, fname, index, exc_msg_queue):
     try:
         r = rut.RawacfRecord.record_from_dics(dics)
         if r.not_corrupt == False:
-            err_str = 'Data inconsistency encountered in rawacf file.'.format(index, fname)
+            err_str = 'Data inconsistency encountered in rawacf file.'
             raise rut.InconsistentRawacfError(err_str)
-        logging.info('\t{0} File  {1}: File processed.'.format(index, fname))
+        logging.info('\t%s File  %s: File processed.', index, fname)
 
     except Exception  as e:
-        err_str = "\t{0} File {1}: Exception raised during process_experiment: {2}"
-        logging.warning(err_str.format(index, fname, e))
+        err_str = "\t%s File %s: Exception raised during process_experiment: %s"
+        logging.warning(err_str, index, fname, e)
         # Tell the write handler to add this to the list of files with bad CPIDS 
         exc_msg_queue.put((fname, e))
         if isinstance(e, rut.BadRawacfError):
@@ -348,46 +507,131 @@ def parse_file(path, fname, index, exc_msg_queue):
 def parse_file_wrapper(args):
     """
     Wrapper for parse_file that takes one argument only (each of which is a
-    tuple of parse_file's arguments).
+    tuple of parse_file's arguments), and gives back the record as a database
+    row, which is much cheaper to send back from a pool worker than the 
+    RawacfRecord object itself.
     
     :param args: tuple of the arguments destined for parse_file
     
-    :returns: the output of parse_file: a [rawacf_utils.RawacfRecord object]
+    If PARSE_CACHE_DIR is set, rows are cached on disk so that a file 
+    that's parsed again (e.g. when re-running an interrupted folder) is read
+    from the cache instead of being decompressed and parsed all over again.
+    Only records without inconsistencies are cached, so that files with 
+    problems are always parsed (and reported in bad_fields.txt) again.
+    
+    :returns: the output of parse_file as a [tuple] from 
+                RawacfRecord.as_tuple(), or None if the file wasn't usable
+    """
+    cache_file = parse_cache_file(args[0], args[1])
+    if cache_file is not None and os.path.isfile(cache_file):
+        logging.info("%s File: %s: Using cached record.", args[2], args[1])
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    r = parse_file(*args)
+    row = None if r is None else r.as_tuple()
+    if cache_file is not None and row is not None and r.not_corrupt:
+        # Written under a temporary name first, so that no one ever reads
+        # a half-written cache file
+        tmp_file = "{0}.{1}".format(cache_file, os.getpid())
+        try:
+            if not os.path.isdir(PARSE_CACHE_DIR):
+                os.makedirs(PARSE_CACHE_DIR)
+        except OSError:
+            pass # Another worker may have just made it
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            logging.warning("Couldn't cache the record for %s", args[1], exc_info=True)
+    return row
+
+def parse_cache_file(path, fname):
+    """
+    Gives the name of the file that caches the database row for a rawacf.
+    Files are told apart by a hash of their name, size, and first 
+    PARSE_CACHE_HASH_BYTES bytes (reading all of a big file would cost 
+    much of what the cache saves).
+
+    :param path: [string] path to file
+    :param fname: [string] name of rawacf file
+
+    :returns: [string] path to the cache file, or None if caching is off
+                or the rawacf can't be read
     """
-    return parse_file(*args)
+    if PARSE_CACHE_DIR is None:
+        return None
+    fpath = path + '/' + fname
+    h = hashlib.sha1()
+    try:
+        with open(fpath, 'rb') as f:
+            h.update(f.read(PARSE_CACHE_HASH_BYTES))
+        # The row's length is included so a change to the table's columns 
+        # doesn't bring back stale rows
+        h.update("{0}:{1}:{2}".format(fname, os.path.getsize(fpath), 
+                                      len(rut.EXPS_FIELDS)).encode())
+    except (IOError, OSError):
+        # Let parse_file deal with (and report) unreadable files
+        return None
+    return os.path.join(PARSE_CACHE_DIR, h.hexdigest() + '.pkl')
   
-def exc_handler_func(exc_msg_queue):
+def exc_handler_func(exc_msg_queue, bad_files_log=BAD_RAWACFS_FILE, 
+                     inconsistents_log=INCONSISTENT_FIELDS_FILE):
     """
     Function for doing the writing to bad_rawacfs.txt and bad_fields.txt to 
-    avoid race conditions between worker processes.
+    avoid race conditions between worker processes. Both files are opened 
+    once and held open, rather than reopened for every bad file. Putting 
+    None on the queue tells the handler to finish up (see stop_exc_handler).
 
     :param exc_msg_queue: [multiprocessing.Queue] that provides a medium
                         for processes to send (rawacf_filename, exception)
                         tuples to handler for printing.
     """
-    while True:
-        if exc_msg_queue.empty():
-            time.sleep(SHORT_SLEEP_INTERVAL)
-        else:
+    with open(bad_files_log, 'a') as bad_f, open(inconsistents_log, 'a') as inc_f:
+        while True:
+            try:
+                msg = exc_msg_queue.get()
+            except (EOFError, IOError):
+                # The queue's gone (e.g. the parent died), so there's
+                # nothing left to wait for
+                logging.error("\t\tWrite handler lost its message queue!", exc_info=True)
+                return
             try:
+                if msg is None:
+                    logging.debug("\t\tWrite handler told to stop")
+                    return
                 logging.debug("\t\tWrite handler received a message!")
-                fname, exc = exc_msg_queue.get()
+                fname, exc = msg
                 if isinstance(exc, rut.InconsistentRawacfError):
                     logging.debug("\t\tWrite handler saving a bad_cpid event")
-                    write_inconsistent_rawacf(fname, exc)
+                    inc_f.write(inconsistent_rawacf_line(fname, exc))
                 elif isinstance(exc, backscatter.dmap.DmapDataError) or isinstance(exc, rut.BadRawacfError):
                     logging.debug("\t\tWrite handler saving a bad_rawacf event")
-                    write_bad_rawacf(fname, exc)
+                    bad_f.write(bad_rawacf_line(fname, exc))
                 elif type(exc) == MemoryError:
                     logging.error("\t\tException handler sees memory error", exc_info=True)
                 else:
-                    err_str = "\t\tHandled miscellaneous 'other' exception: {0}"
-                    logging.debug(err_str.format(exc))
+                    logging.debug("\t\tHandled miscellaneous 'other' exception: %s", exc)
             except TypeError:
                 logging.error("\t\tWrite handler had trouble unpacking message!", exc_info=True)
             except IOError:
                 logging.error("\t\tWrite handler had trouble writing!", exc_info=True)
 
+def stop_exc_handler(exc_msg_queue, write_handler):
+    """
+    Tells the exception handler process to stop once it has written out the
+    messages already queued, and waits for it (terminating it if it takes
+    too long).
+
+    :param exc_msg_queue: [multiprocessing.Queue] the handler reads from
+    :param write_handler: [multiprocessing.Process] running exc_handler_func
+    """
+    exc_msg_queue.put(None)
+    write_handler.join(SUBPROC_JOIN_TIMEOUT)
+    if write_handler.is_alive():
+        logging.warning("Write handler didn't stop in time, terminating it")
+        write_handler.terminate()
+
 def write_inconsistent_rawacf(fname, exc, inconsistents_log=INCONSISTENT_FIELDS_FILE):
     """
     Performs the actual writing to the bad_fields.txt file.
@@ -397,7 +641,13 @@ def write_inconsistent_rawacf(fname, exc, inconsistents_log=INCONSISTENT_FIELDS_
     """
     # ***ADD TO LIST OF INCONSISTENT_FIELDS ***
     with open(inconsistents_log, 'a') as f:
-        f.write(fname + ':' + str(exc) + '\n')
+        f.write(inconsistent_rawacf_line(fname, exc))
+
+def inconsistent_rawacf_line(fname, exc):
+    """
+    Formats the bad_fields.txt line for a file with inconsistent fields.
+    """
+    return fname + ':' + str(exc) + '\n'
 
 def write_bad_rawacf(fname, exc, bad_files_log=BAD_RAWACFS_FILE): 
     """
@@ -409,11 +659,16 @@ def write_bad_rawacf(fname, exc, bad_files_log=BAD_RAWACFS_FILE):
     """
     # ***ADD TO LIST OF BAD_RAWACFS ***
     with open(bad_files_log, 'a') as f:
-        # Backscatter exceptions have a newline that looks bad in 
-        # logs, so I remove them here
-        exc_tmp = str(exc).split('\n')
-        exc_tmp = reduce(lambda x, y: x+y, exc_tmp)
-        f.write(fname + ':"' + str(exc_tmp) + '"\n')
+        f.write(bad_rawacf_line(fname, exc))
+
+def bad_rawacf_line(fname, exc):
+    """
+    Formats the bad_rawacfs.txt line for a file backscatter couldn't read.
+    """
+    # Backscatter exceptions have a newline that looks bad in 
+    # logs, so I remove them here
+    exc_tmp = ''.join(str(exc).split('\n'))
+    return fname + ':"' + exc_tmp + '"\n'
  
 #------------------------------------------------------------------------------ 
 #                       Command-Line Usability
@@ -447,16 +702,18 @@ def get_args():
     args = parser.parse_args()
     return args
 
-def process_args(year, month, day, st_code, directory, fname):
+def process_args(year, month, day, st_code, directory, fname, conn):
     """
     Function which handles interpreting what kind of processing request
     to make.
+
+    :param conn: [sqlite3 connection] to the database for saving to
     """
     # Highest precedence: if a particular file is provided as an arg.
     if fname is not None:
         if os.path.isfile(fname):
             logging.info("Parsing file {0}".format(fname))
-            process_file(fname)
+            process_file(fname, conn=conn)
             return
         else:
             logging.error("Invalid filename.")
@@ -465,7 +722,7 @@ def process_args(year, month, day, st_code, directory, fname):
     if directory is not None:
         if os.path.isdir(directory): 
             logging.info("Parsing files in directory {0}".format(directory))
-            parse_rawacf_folder(directory)
+            parse_rawacf_folder(directory, conn=conn, multiprocess=True)
             return
         else:
             logging.error("Invalid directory.")
@@ -476,12 +733,12 @@ def process_args(year, month, day, st_code, directory, fname):
             msg = "Proceeding to fetch and parse data from {0}-{1}-{2}"
             logging.info(msg.format(year, month, day))
             logging.info("By the way, station code supplied to this was: '{0}'".format(st_code))
-            process_rawacfs_day(year, month, day, station_code=st_code)
+            process_rawacfs_day(year, month, day, station_code=st_code, conn=conn)
             return
         else:
             msg = "Proceeding to fetch and parse data in {0}-{1}"
             logging.info(msg.format(year, month))
-            process_rawacfs_month(year, month)
+            process_rawacfs_month(year, month, conn=conn)
             return
     else:
         logging.info("Some form of argument is kinda required!")
@@ -524,5 +781,5 @@ if __name__ == "__main__":
 
     rut.read_config() 
     conn = rut.connect_db()
-    cur = conn.cursor()
-    process_args(year, month, day, st_code, directory, fname)
+    process_args(year, month, day, st_code, directory, fname, conn)
+    conn.close()
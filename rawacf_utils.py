@@ -16,19 +16,83 @@ import logging
 import os
 import sys
 import subprocess
+import calendar
+import bz2
+import gc
+import itertools
+import mmap
 
 import sqlite3
 import numpy as np
 
-import dateutil.parser
 from datetime import datetime as dt
+from operator import itemgetter
 
-logging.basicConfig(level=logging.DEBUG,
+logging.basicConfig(level=logging.INFO,
     format='%(levelname)s %(asctime)s: %(message)s', 
     datefmt='%m/%d/%Y %I:%M:%S %p')
 
 CONSISTENT_RAWACF_THRESH = 20
 
+# dmap fields that should hold the same value throughout a rawacf, and all 
+# the fields that check_fields() looks at
+CONSISTENT_FIELDS = ('cp', 'origin.command', 'stid', 'xcf')
+CHECKED_FIELDS = CONSISTENT_FIELDS + ('txpl', 'rsep', 'bmnum')
+# dmap fields giving the time of each entry
+TIME_FIELDS = ('time.yr', 'time.mo', 'time.dy', 'time.hr', 'time.mt', 'time.sc', 
+               'time.us')
+
+# Columns of the exps table, in the order RawacfRecord.as_tuple() gives them
+EXPS_FIELDS = ('stid', 'start_iso', 'end_iso', 'cmd_name', 'cmd_args', 'cpid', 
+               'min_nave', 'times_consistent', 'not_corrupt', 'min_tfreq',
+               'max_tfreq', 'xcf', 'start_epoch', 'end_epoch')
+# Built once from the columns so sqlite's statement cache is hit on every 
+# insert. The bulk statement inserts many rows per execution; older sqlite 
+# builds only allow 999 '?' placeholders in a statement, which bounds it
+EXPS_ROW_PLACEHOLDERS = '({0})'.format(', '.join('?'*len(EXPS_FIELDS)))
+INSERT_SQL = 'INSERT INTO exps ({0}) VALUES {1}'.format(', '.join(EXPS_FIELDS),
+                                                        EXPS_ROW_PLACEHOLDERS)
+ROWS_PER_BULK_INSERT = 999 // len(EXPS_FIELDS)
+BULK_INSERT_SQL = INSERT_SQL + (', ' + EXPS_ROW_PLACEHOLDERS)*(ROWS_PER_BULK_INSERT - 1)
+# Number of entries moved at a time when copying between databases
+COPY_BATCH_SIZE = 1000
+
+# Columns handed back by select_exps_columnar, one numpy field per column.
+# Times are given in epoch seconds.
+EXPS_COLUMNS_DTYPE = np.dtype([('stid', 'i2'), ('start', 'f8'), ('end', 'f8')])
+
+# The experiments table. The start/end times are kept both as ISO strings 
+# and as seconds since the epoch, so the stats don't have to parse the times
+EXPS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS exps (
+    stid integer NOT NULL,
+    start_iso text NOT NULL,
+    end_iso text NOT NULL,
+    cmd_name text,
+    cmd_args text,
+    cpid integer,
+    min_nave integer,
+    times_consistent BOOLEAN,
+    not_corrupt BOOLEAN,
+    min_tfreq integer,
+    max_tfreq integer,
+    xcf integer,
+    start_epoch real,
+    end_epoch real,
+    PRIMARY KEY (stid, start_iso)
+    );
+    """
+# An index that answers the stats queries (a station's experiments over a 
+# time range) without touching the table at all. The queries bound start_epoch
+# on both sides (see uptime.MAX_RECORD_SECONDS), so they're a range scan over
+# just the entries starting near the time range. (It replaces an older, wider
+# one that also held the cpid, which databases made before may still have.)
+EXPS_INDEXES = """
+    DROP INDEX IF EXISTS idx_exps_stid_epoch;
+    CREATE INDEX IF NOT EXISTS idx_exps_stid_epochs ON exps 
+        (stid, start_epoch, end_epoch);
+    """
+
 radars16 = {'cly': 66, 'gbr': 1, 'han': 10, 'hok': 40, 'hkw': 41, 'inv': 64,
             'kap': 3, 'ksr': 16, 'kod': 7, 'lyr': 90, 'pyk': 9, 'pgr': 6, 
             'rkn': 65, 'sas': 5, 'sch': 2, 'sto': 8, 'dce': 96, 'fir': 21,
@@ -40,6 +104,9 @@ allradars = radars16.copy()
 allradars.update(radars22)
 allradars.update(radars24)
 
+# Number of days in each (year, month) that's been looked up so far
+month_lengths = dict()
+
 class InconsistentRawacfError(Exception):
     """
     Raised when data from a rawacf file is inconsistent or incorrectly
@@ -64,6 +131,8 @@ class RawacfRecord(object):
         - stid (station ID) : number corresponding to which array it is
         - start_dt: time of the start of the .rawacf entry (datetime obj)
         - end_dt : time of the end of the .rawacf entry (datetime obj)
+        - start_ep, end_ep : start_dt and end_dt in seconds since the epoch,
+                    computed once up front for uptime calculations
         - cpid : Control program ID number
         - cmd_name : program name that was called to create this .rawacf 
                 file (note: CPIDs and cmd_names should match eachother)
@@ -87,12 +156,19 @@ class RawacfRecord(object):
         - Constructor (8 parameters)
         - __repr__ string
         - duration(): returns duration of this record in seconds
+        - as_tuple(): returns the record's fields in database column order
         - save_to_db(): saves the record as a database entry, given a db cursor
         - [Class method]: record_from_tuple(): build a RawacfRecord from a 
                 tuple of relevant information (likely originating from database)
         - [Class method]: record_from_dics(): build a RawacfRecord from a 
                 list of dict (dmap records) originating from a .rawacf file
     """
+    # Records are made by the thousand (e.g. by select_exps), so they're kept 
+    # lean: no per-instance __dict__
+    __slots__ = ('stid', 'start_dt', 'end_dt', 'start_ep', 'end_ep', 'cpid',
+                 'cmd_name', 'cmd_args', 'min_nave', 'times_consistent',
+                 'not_corrupt', 'min_tfreq', 'max_tfreq', 'xcf')
+
     def __init__(self, stid, start_dt, end_dt, cmd_name="", cmd_args="", cpid=0,
                  min_nave=0, times_consistent=True, not_corrupt=True,
                  min_tfreq=0., max_tfreq=0., xcf=0.):
@@ -101,6 +177,8 @@ class RawacfRecord(object):
         """
         self.start_dt = start_dt
         self.end_dt = end_dt
+        self.start_ep = get_epoch_seconds(start_dt)
+        self.end_ep = get_epoch_seconds(end_dt)
         self.stid = stid
         self.cpid = cpid
         self.cmd_name = cmd_name
@@ -131,9 +209,22 @@ class RawacfRecord(object):
         
         :returns: total difference in seconds of end time minus start time
         """
-        # datetimes can be subtracted to get intervals
-        diff = self.end_dt - self.start_dt
-        return diff.total_seconds()
+        return self.end_ep - self.start_ep
+
+    def as_tuple(self):
+        """
+        Puts the object's fields into a tuple ordered the same way as the
+        columns in INSERT_SQL.
+
+        :returns: [tuple] of the record's fields, ready for the database
+        """
+        start_time = (self.start_dt).isoformat()
+        end_time = (self.end_dt).isoformat()
+        return (self.stid, start_time, end_time, 
+                self.cmd_name, self.cmd_args, self.cpid,
+                self.min_nave, self.times_consistent, 
+                self.not_corrupt, self.min_tfreq, self.max_tfreq, self.xcf,
+                self.start_ep, self.end_ep)
 
     def save_to_db(self, cur):
         """
@@ -142,21 +233,7 @@ class RawacfRecord(object):
 
         :param cur: Cursor to an sqlite3 database to save to.
         """
-        start_time = (self.start_dt).isoformat()
-        end_time = (self.end_dt).isoformat()
-        try:
-            cur.execute('''INSERT INTO exps (stid, start_iso, end_iso, 
-            cmd_name, cmd_args, cpid, min_nave, times_consistent, not_corrupt,
-            min_tfreq, max_tfreq, xcf) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (self.stid, start_time, end_time, 
-            self.cmd_name, self.cmd_args, self.cpid,
-            int(self.min_nave), int(self.times_consistent), 
-            int(self.not_corrupt), self.min_tfreq, self.max_tfreq, self.xcf))
-        except sqlite3.IntegrityError:
-            logging.error("Unique constraint failed or something.")     
-        except sqlite3.OperationalError: 
-            logging.error("\t\tDatabase locked - can't save metadata!")
+        insert_row(self.as_tuple(), cur)
 
     # Class method to read a tuple from the sqlite db and make a RawacfRecord
     @classmethod
@@ -172,12 +249,13 @@ class RawacfRecord(object):
         :returns: RawacfRecord object constructed from tuple's fields
             
         """
-        assert(len(tup) == 12)
+        # Entries from databases made before the epoch columns have 12 fields
+        assert(len(tup) in (12, len(EXPS_FIELDS)))
         assert(tup[0] != None and tup[1] != None and tup[2] != None)
         stid, start_iso, end_iso = (tup[:3])
         cmd_name, cmd_args, cpid = (tup[3:6])
         min_nave, times_consistent, not_corrupt = (tup[6:9])
-        min_tfreq, max_tfreq, xcf = (tup[-3:])
+        min_tfreq, max_tfreq, xcf = (tup[9:12])
         start_dt = iso_to_dt(start_iso)
         end_dt = iso_to_dt(end_iso)
         # Use contents of tuple as arguments for RawacfRecord constructor
@@ -199,13 +277,16 @@ class RawacfRecord(object):
         :returns: RawacfRecord constructed from information in the dicts
         """ 
         assert(type(dmap_dicts)==list)
-        assert(type(dmap_dicts[0]==dict))
+        assert(isinstance(dmap_dicts[0], dict))
         if len(dmap_dicts) <= 1:
             logging.error("** Rare circumstance: A single-entry rawacf dmap! ***")
             err_str = "DMAP record found with only one data point. "
             raise BadRawacfError(err_str)
 
-        objection_dict = check_fields(dmap_dicts)
+        # Everything that's checked or summarized is pulled out in one pass
+        cols = dmap_columns(dmap_dicts, 
+                            CHECKED_FIELDS + ('tfreq', 'nave') + TIME_FIELDS)
+        objection_dict = check_fields(dmap_dicts, cols)
         cpid = dmap_dicts[0]['cp'] if 'cp' not in objection_dict else -1
         stid = dmap_dicts[0]['stid'] if 'stid' not in objection_dict else -1
         cmd  = dmap_dicts[0]['origin.command'] if 'origin.command' not in objection_dict else "" 
@@ -223,29 +304,24 @@ class RawacfRecord(object):
             logging.debug(err_str)
 
         # ** Grab tfreq **
-        tfreqs = [ d['tfreq'] for d in dmap_dicts ]
-        min_tfreq = min(tfreqs)
-        max_tfreq = max(tfreqs)
+        min_tfreq = cols['tfreq'].min().item()
+        max_tfreq = cols['tfreq'].max().item()
 
         # ** Get the lowest n_ave value **
-        min_nave = min([ d['nave'] for d in dmap_dicts ])
+        min_nave = cols['nave'].min().item()
  
         # Parse the start/end temporal fields 
         try:
             start_dt = reconstruct_datetime(dmap_dicts[0])
             end_dt = reconstruct_datetime(dmap_dicts[-1])
-             
-            # Check for downtime during the experiment's run
-            ts = []
-            for d in dmap_dicts:
-                ts.append(reconstruct_datetime(d))
         except ValueError:
             logging.error("Possible microsecond-related error.", exc_info=True)
-            err_str = "Microseconds in start and end dts: {0}, {1}"
-            logging.error(err_str.format(dmap_dicts[0]['time.us'], dmap_dicts[-1]['time.us']))
-        diffs = [(ts[i+1] - ts[i]).total_seconds() for i in range( len(ts) - 1 )]
-        # Check that every difference between entries is 20 seconds or less
-        times_consistent = int(( np.array(diffs) < CONSISTENT_RAWACF_THRESH ).all())
+            logging.error("Microseconds in start and end dts: %s, %s", 
+                          dmap_dicts[0]['time.us'], dmap_dicts[-1]['time.us'])
+        # Check for downtime during the experiment's run: every difference 
+        # between entries should be 20 seconds or less
+        diffs = np.diff(dmap_epoch_seconds(dmap_dicts, cols))
+        times_consistent = int(( diffs < CONSISTENT_RAWACF_THRESH ).all())
 
         if 'not_corrupt' not in locals():
             not_corrupt = True
@@ -270,15 +346,24 @@ def bz2_dic(fname):
     :returns: list of dictionaries from backscatter lib's parsing of
                 the .rawacf file
     """
-    import bz2
-    if not os.path.isfile(fname):
-        raise IOError('Not a file! {0}'.format(fname))
-    if fname[-4:] != '.bz2':
+    # (Nonexistent files raise an IOError when opened, so there's no need
+    # to stat them beforehand)
+    if not fname.endswith('.bz2'):
         raise IOError('Not a .bz2 file! {0}'.format(fname))
-    f = bz2.BZ2File(fname,'rb')
-    stream = f.read()
-    dics = backscatter.dmap.parse_dmap_format_from_stream(stream)
-    return dics
+    # Release the file before parsing rather than whenever it's collected.
+    # Decompressing the whole file in one go sizes the output once, rather
+    # than growing it chunk by chunk as BZ2File.read() does. The compressed
+    # data is mapped rather than read, so only the decompressed copy is held
+    with open(fname,'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # (Empty files can't be mapped; backscatter will complain instead)
+            return parse_dmap_stream(b'')
+        compressed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            stream = bz2.decompress(compressed)
+        finally:
+            compressed.close()
+    return parse_dmap_stream(stream)
 
 def acf_dic(fname):
     """ 
@@ -290,13 +375,40 @@ def acf_dic(fname):
     :returns: list of dictionaries from backscatter lib's parsing of
                 the .rawacf file
     """
-    if not os.path.isfile(fname):
-        raise IOError('Not a file!')
-    if fname[-7:] != '.rawacf':
+    if not fname.endswith('.rawacf'):
         raise IOError('Not a .rawacf file!')
-    f = open(fname,'rb')
-    stream = f.read()
-    dics = backscatter.dmap.parse_dmap_format_from_stream(stream)
+    with open(fname,'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # (Empty files can't be mapped; backscatter will complain instead)
+            return parse_dmap_stream(b'')
+        # Map the file instead of reading it into memory. Backscatter makes 
+        # its own copy of the data, so this saves holding a second one
+        stream = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parse_dmap_stream(stream)
+        finally:
+            stream.close()
+
+def parse_dmap_stream(stream):
+    """
+    Parses a stream of dmap records with the backscatter library. 
+
+    Parsing allocates thousands of dicts which all outlive the parse, so the
+    garbage collector is paused meanwhile; otherwise it keeps rescanning 
+    the growing list of them for cycles that aren't there.
+
+    :param stream: [bytes] of dmap records, e.g. the contents of a .rawacf
+
+    :returns: list of dictionaries from backscatter lib's parsing of
+                the stream
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        dics = backscatter.dmap.parse_dmap_format_from_stream(stream)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
     return dics
 
 def globus_connect():
@@ -334,11 +446,11 @@ def globus_disconnect():
                                     stdin=procs.stdout, stdout=subprocess.PIPE)
     cut = subprocess.check_output(['cut', '-d', ' ', '-f', '3'], stdin=grep.stdout)
     for pid in cut.split('\n')[:-1]:
-        logging.debug("Preparing to kill PID #{0}...".format(pid))
+        logging.debug("Preparing to kill PID #%s...", pid)
         try:
             out = subprocess.check_output(['kill','-s','SIGKILL',pid])
         except subprocess.CalledProcessError as e:
-            logging.debug("Error with kill of {0}: {1}".format(pid, e))
+            logging.debug("Error with kill of %s: %s", pid, e)
 
 def globus_query(script_query):
     """
@@ -415,7 +527,42 @@ def reconstruct_datetime(dic):
            dic['time.mt'], dic['time.sc'], dic['time.us']) 
     return t
 
-def check_fields(dmap_dicts):
+def dmap_epoch_seconds(dmap_dicts, cols=None):
+    """
+    Works out the times of all the dmap dictionaries from a rawacf at once, 
+    with numpy, rather than building a datetime for each one. Spurious 
+    microsecond values are treated as 1 us, like reconstruct_datetime does.
+
+    :param dmap_dicts: the list of dicts from backscatter lib's parse of a .rawacf
+    :param cols: [dict] (optional) of the TIME_FIELDS already pulled out 
+                of the dicts by dmap_columns(), to save doing it again
+
+    :returns: [numpy array] of each dict's time in seconds since the epoch
+    """
+    if cols is None:
+        cols = dmap_columns(dmap_dicts, TIME_FIELDS)
+    yr, mo, dy, hr, mt, sc, us = (cols[f].astype(np.int64) for f in TIME_FIELDS)
+    us = np.where((us < 0) | (us > 999999), 1, us)
+    # Whole months since the epoch, converted to days, gets us the date
+    months = (yr - 1970)*12 + (mo - 1)
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + dy - 1
+    return days*86400. + hr*3600. + mt*60. + sc + 1E-6*us
+
+def dmap_columns(dmap_dicts, fields):
+    """
+    Pulls some scalar fields out of the dmap dictionaries from a rawacf in 
+    a single pass, giving one numpy array per field (a 'struct of arrays'),
+    so that checks on the fields can be done on whole arrays at once.
+
+    :param dmap_dicts: the list of dicts from backscatter lib's parse of a .rawacf
+    :param fields: [iterable] of the names of the fields to pull out
+
+    :returns: [dict] of numpy arrays, keyed by field name
+    """
+    rows = [tuple(d[f] for f in fields) for d in dmap_dicts]
+    return dict((f, np.array(col)) for f, col in zip(fields, zip(*rows)))
+
+def check_fields(dmap_dicts, cols=None):
     """
     Takes a list of dictionaries representing the dmap object for a 
     rawacf file as well as a particular field, and extracts the field 
@@ -423,33 +570,40 @@ def check_fields(dmap_dicts):
     the list. If not, raises an exception indicating likely corrupted record
 
     :param dics: the list of dicts from backscatter lib's parse of a .rawacf
+    :param cols: [dict] (optional) of the CHECKED_FIELDS already pulled out 
+                of the dicts by dmap_columns(), to save doing it again
     
     :returns: [abstract] the value that's been requested if it's consistent    
     """
     objection_dict = dict()
-    for i, dmap_dict in enumerate(dmap_dicts):
-        # Check if some fields are consistent throughout
-        for field in ['cp', 'origin.command', 'stid', 'xcf']: 
-            val = dmap_dict[field]
-            first_val = dmap_dicts[0][field]
-            if first_val != val:
-                # Current value of field is different from first value
-                dbg_str = "\t\tcheck_field() was seeing record of {0} for ".format(first_val)
-                dbg_str += "'{0}' but now sees {1} at index {2} of {3}".format(field, val, i, len(dmap_dicts))
-                objection_dict[field] = dbg_str
-                #raise InconsistentRawacfError(dbg_str)
-        # Check if rsep corresponds to txpl
-        txpl = dmap_dict['txpl']
-        rsep = dmap_dict['rsep']
-        if (txpl*3/20) != rsep:
-            dbg_str = "Fields 'rsep' and 'txpl' are inconsistent with each other."
-            dbg_str += "\trsep: {0}, txpl: {1}".format(rsep, txpl)
-            objection_dict['rsep'] = objection_dict['txpl'] = dbg_str
-        # Check if bmnum is valid ?
-        range_max = 16 if dmap_dict['stid'] in radars16.values() else 24
-        if dmap_dict['bmnum'] not in range(range_max):
-            dbg_str = "Saw unexpected value of 'bmnum'"
-            objection_dict['bmnum'] = dbg_str
+    if cols is None:
+        cols = dmap_columns(dmap_dicts, CHECKED_FIELDS)
+    # Check if some fields are consistent throughout
+    for field in CONSISTENT_FIELDS: 
+        vals = cols[field]
+        differing = np.flatnonzero(vals != vals[0])
+        if len(differing) > 0:
+            # Report the last entry whose value differs from the first one's
+            i = differing[-1]
+            dbg_str = "\t\tcheck_field() was seeing record of {0} for ".format(vals[0])
+            dbg_str += "'{0}' but now sees {1} at index {2} of {3}".format(field, vals[i], i, len(dmap_dicts))
+            objection_dict[field] = dbg_str
+            #raise InconsistentRawacfError(dbg_str)
+    # Check if rsep corresponds to txpl
+    txpl = cols['txpl']
+    rsep = cols['rsep']
+    mismatched = np.flatnonzero((txpl*3/20) != rsep)
+    if len(mismatched) > 0:
+        i = mismatched[-1]
+        dbg_str = "Fields 'rsep' and 'txpl' are inconsistent with each other."
+        dbg_str += "\trsep: {0}, txpl: {1}".format(rsep[i], txpl[i])
+        objection_dict['rsep'] = objection_dict['txpl'] = dbg_str
+    # Check if bmnum is valid ?
+    range_max = np.where(np.isin(cols['stid'], list(radars16.values())), 16, 24)
+    bmnum = cols['bmnum']
+    if ((bmnum < 0) | (bmnum >= range_max)).any():
+        dbg_str = "Saw unexpected value of 'bmnum'"
+        objection_dict['bmnum'] = dbg_str
     return objection_dict
 
 def has_positive_nave(dics):
@@ -460,76 +614,39 @@ def has_positive_nave(dics):
 
     :returns: [boolean] True/False stating whether all vals of 'nave' are positive
     """
-    for i in dics:
-        if i['nave'] <= 0:
-            return False
-    return True 
-
-def two_pad(num):
-    """ 
-    Takes in a number of 1 or 2 digits, returns a string of two digits. 
-
-    :param num: an [int] between 0 and 99
-
-    :returns: a [str] of length 2
-    """
-    assert isinstance(num,int)
-    assert (num < 100 and num >= 0)
-    return "0" + str(num) if str(num).__len__() == 1 else str(num)
-
-def get_datestr(dt_obj):
-    """
-    Return a datestring in format "20160418". 
-
-    :param dt_obj: a [Datetime] object
-    
-    :returns: a [str] of format yyyymmdd
-    """
-#    return str(dt_obj.year) + two_pad(dt_obj.month) + two_pad(dt_obj.day)
-    return str(dt_obj.year) + "{:02d}".format(dt_obj.month) + "{:02d}".format(dt_obj.day)
+    return bool((dmap_columns(dics, ['nave'])['nave'] > 0).all())
 
-def get_timestr(dt_obj):
+def get_tod_seconds(dt_obj):
     """
-    Return a time in the format "01:00:00"
+    Returns the time of day (since 00h00m00s) in seconds
 
     :param dt_obj: a [Datetime] object
 
-    :returns: a [str] of format hh:mm:ss (hours, min, sec)
+    :returns: a [float] of seconds since the start of the day '00:00:00'
     """
-    return str(dt_obj.hour) + ":" + str(dt_obj.minute) + ":" + str(dt_obj.second)
+    return dt_obj.hour*3600. + dt_obj.minute*60. + dt_obj.second + 1E-6*dt_obj.microsecond
 
-def get_tod_seconds(dt_obj):
+def get_epoch_seconds(dt_obj):
     """
-    Returns the time of day (since 00h00m00s) in seconds
+    Returns the time in seconds since the Unix epoch, treating the 
+    (naive) datetime as being in UTC.
 
     :param dt_obj: a [Datetime] object
 
-    :returns: a [float] of seconds since the start of the day '00:00:00'
+    :returns: a [float] of seconds since 1970-01-01T00:00:00
     """
-    return dt_obj.hour*3600. + dt_obj.minute*60. + dt_obj.second + 1E-6*dt_obj.microsecond
+    return calendar.timegm(dt_obj.timetuple()) + 1E-6*dt_obj.microsecond
 
 def iso_to_dt(iso):
     """
     Parses an iso formatted time, returns datetime object
 
-    :param iso: a [str] of a date & time in ISO format 
-                e.g. "2017-06-30T10:51:43.68922"
+    :param iso: a [str] of a date & time in ISO format, as given by
+                datetime.isoformat(), e.g. "2017-06-30T10:51:43.689220"
 
     :returns: a [Datetime] object
     """
-    yr,mo,dy = map(int,(iso.split("T")[0]).split('-'))
-    hr,mt,sc = (iso.split("T")[1]).split(':')
-    hr, mt = map(int, [hr, mt])
-    # In some exceptional cases there are no us, so handle this carefully
-    if len(sc.split('.')) == 1:
-        # Case where there's no microseconds
-        logging.debug("No microseconds!")
-        sc = int(sc)
-        us = 0
-    else:
-        sc, us = map(int, sc.split('.'))
-    out = dt(yr, mo, dy, hr, mt, sc, us)
-    return out
+    return dt.fromisoformat(iso)
 
 def clear_endpoint():
     """
@@ -559,6 +676,21 @@ def month_year_iterator(start_month, start_year, end_month, end_year):
         y, m = divmod(ym, 12)
         yield y, m + 1
 
+def days_in_month(year, month):
+    """
+    Returns the number of days in a month. The answer is remembered, since
+    the same few months tend to get asked about over and over.
+
+    :param year: [int] the year
+    :param month: [int] the month, from 1 to 12
+
+    :returns: [int] the number of days in that month
+    """
+    key = (year, month)
+    if key not in month_lengths:
+        month_lengths[key] = calendar.monthrange(year, month)[1]
+    return month_lengths[key]
+
 def get_stid(st_code):
     """
     Given a SuperDARN radar code, grab the STID
@@ -598,48 +730,73 @@ def connect_db(dbname="superdarntimes.sqlite"):
     - min_tfreq:
     - max_tfreq:
     - xcf:
+    - start_epoch : start_iso in seconds since the epoch
+    - end_epoch : end_iso in seconds since the epoch
 
 
     *** not_corrupt and times_consistent are currently stored as integers
     expected to only take on values of "1" or "0" ***
+
+    The connection is set up for bulk inserts: a write-ahead log with
+    'NORMAL' syncing (so commits don't each force an fsync of the database),
+    temporary storage in memory and a 64 MB page cache. New databases get 
+    16 kB pages, for shallower B-trees and fewer page reads per range scan
+    (existing ones keep theirs, as WAL mode fixes it). Up to 256 MB of the
+    database file is memory-mapped, so that reads (e.g. for the stats) come
+    straight from the OS page cache rather than through read() calls.
     """
     
     conn = sqlite3.connect(dbname)
     cur = conn.cursor()
     cur.executescript("""
-    CREATE TABLE IF NOT EXISTS exps (
-    stid integer NOT NULL,
-    start_iso text NOT NULL,
-    end_iso text NOT NULL,
-    cmd_name text,
-    cmd_args text,
-    cpid integer,
-    min_nave integer,
-    times_consistent BOOLEAN,
-    not_corrupt BOOLEAN,
-    min_tfreq integer,
-    max_tfreq integer,
-    xcf integer,
-    PRIMARY KEY (stid, start_iso)
-    );
-    """) 
+    PRAGMA page_size=16384;
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+    """)
+    cur.executescript(EXPS_SCHEMA) 
+    upgrade_db(cur)
+    cur.executescript(EXPS_INDEXES) 
     db_correct = check_db(cur)
     if not db_correct:
         logging.error("Database incorrectly configured.")
     return conn
 
+def upgrade_db(cur):
+    """
+    Brings a database made before the start_epoch/end_epoch columns existed
+    up to date, filling those columns in from the ISO times of the entries
+    already in it.
+
+    :param cur: Cursor to an sqlite3 database
+    """
+    cur.execute('PRAGMA table_info (exps)')
+    tbl_flds = [ en[1] for en in cur.fetchall() ]
+    if 'start_epoch' in tbl_flds:
+        return
+    logging.info("Adding epoch time columns to the database...")
+    cur.execute('ALTER TABLE exps ADD COLUMN start_epoch real')
+    cur.execute('ALTER TABLE exps ADD COLUMN end_epoch real')
+    # The old time index is superseded by the one on the epoch columns
+    cur.execute('DROP INDEX IF EXISTS idx_exps_stid_time')
+    cur.execute('SELECT rowid, start_iso, end_iso FROM exps')
+    epochs = [(get_epoch_seconds(iso_to_dt(start_iso)), 
+               get_epoch_seconds(iso_to_dt(end_iso)), rowid)
+              for rowid, start_iso, end_iso in cur.fetchall()]
+    cur.executemany('UPDATE exps SET start_epoch=?, end_epoch=? WHERE rowid=?', epochs)
+    cur.connection.commit()
+
 def check_db(cur):
     """
     Given a cursor to a DB, checks that it has the right structuring.
     """
     # And if it *did* exist, make sure it has all the necessary fields:
     cur.execute('PRAGMA table_info (exps)')
-    flds = ['stid', 'start_iso', 'end_iso', 'cmd_name', 'cmd_args', 'cpid', 
-            'min_nave', 'times_consistent', 'not_corrupt', 'min_tfreq',
-            'max_tfreq', 'xcf']
     tbl_flds = [ en[1] for en in cur.fetchall() ]
     db_correct = True
-    for f in flds:
+    for f in EXPS_FIELDS:
         if f not in tbl_flds:
             db_correct = False
     return db_correct
@@ -648,25 +805,9 @@ def clear_db(cur):
     """
     Clears all experiment information in the sqlite3 database.
     """
-    cur.executescript("""
-    DROP TABLE IF EXISTS exps;
-
-    CREATE TABLE IF NOT EXISTS exps (
-    stid integer NOT NULL,
-    start_iso text NOT NULL,
-    end_iso text NOT NULL,
-    cmd_name text,
-    cmd_args text,
-    cpid integer,
-    min_nave integer,
-    times_consistent BOOLEAN,
-    not_corrupt BOOLEAN,
-    min_tfreq integer,
-    max_tfreq integer,
-    xcf integer,
-    PRIMARY KEY (stid, start_iso)
-    );
-    """) 
+    cur.execute('DROP TABLE IF EXISTS exps')
+    cur.executescript(EXPS_SCHEMA) 
+    cur.executescript(EXPS_INDEXES) 
    
 def process_experiment(dics, conn):
     """
@@ -676,24 +817,98 @@ def process_experiment(dics, conn):
     """
     cur = conn.cursor()
     r = RawacfRecord.record_from_dics(dics)
-    r.save_to_db()
+    r.save_to_db(cur)
     return r
 
-def select_exps(sql_select, cur):
+def insert_row(row, cur):
+    """
+    Inserts a single experiment entry into the database, logging rather
+    than raising if it can't be saved.
+
+    :param row: [tuple] of fields ordered as in INSERT_SQL
+    :param cur: Cursor to an sqlite3 database to save to.
+    """
+    try:
+        cur.execute(INSERT_SQL, row)
+    except sqlite3.IntegrityError:
+        logging.error("Unique constraint failed or something.")     
+    except sqlite3.OperationalError: 
+        logging.error("\t\tDatabase locked - can't save metadata!")
+
+def insert_rows(rows, cur):
+    """
+    Inserts a batch of experiment entries into the database, 
+    ROWS_PER_BULK_INSERT entries per statement (the leftovers go in one by
+    one). If an entry in the batch is already in the database, the batch 
+    is rolled back and the entries are inserted one at a time so that the 
+    rest of them still get saved.
+
+    :param rows: [list] of tuples of fields ordered as in INSERT_SQL
+                (e.g. from RawacfRecord.as_tuple())
+    :param cur: Cursor to an sqlite3 database to save to.
+    """
+    # Going in primary key (stid, start_iso) order, consecutive entries land
+    # on the same index pages instead of being scattered across the B-tree
+    rows = sorted(rows, key=itemgetter(0, 1))
+    savepoint_open = False
+    try:
+        cur.execute('SAVEPOINT insert_rows')
+        savepoint_open = True
+        try:
+            num_bulk = len(rows) - len(rows) % ROWS_PER_BULK_INSERT
+            bulk_params = (tuple(itertools.chain.from_iterable(rows[i:i+ROWS_PER_BULK_INSERT]))
+                           for i in range(0, num_bulk, ROWS_PER_BULK_INSERT))
+            cur.executemany(BULK_INSERT_SQL, bulk_params)
+            cur.executemany(INSERT_SQL, rows[num_bulk:])
+        except sqlite3.IntegrityError:
+            logging.debug("Duplicate entry in batch, inserting entries one by one")
+            cur.execute('ROLLBACK TO insert_rows')
+            for row in rows:
+                insert_row(row, cur)
+        cur.execute('RELEASE insert_rows')
+    except sqlite3.OperationalError as e: 
+        if savepoint_open:
+            # Undo whatever part of the batch got written, so the caller's 
+            # commit doesn't save half of it (or leave the savepoint open)
+            cur.execute('ROLLBACK TO insert_rows')
+            cur.execute('RELEASE insert_rows')
+        logging.error("\t\tCouldn't save batch of metadata: %s", e)
+
+def select_exps(sql_select, cur, params=()):
     """
     Takes an sql query to select certain experiments, returns the list
     of RawacfRecord objects
+
+    [:param params:] [tuple] of values for any '?' placeholders in the query
     """
-    logging.debug("Querying with the following string:\n{0}".format(sql_select))
-    cur.execute(sql_select)
+    logging.debug("Querying with the following string:\n%s", sql_select)
+    cur.execute(sql_select, params)
     entries = cur.fetchall()
     records = []
+    # Checked once, rather than making a logging call for every entry
+    log_entries = logging.getLogger().isEnabledFor(logging.DEBUG)
     for entry in entries:
         # Do construction of experiment object from SQL output
-        logging.debug("Looking at entry: {0}".format(entry))
+        if log_entries:
+            logging.debug("Looking at entry: %s", entry)
         records.append(RawacfRecord.record_from_tuple(entry))
     return records
 
+def select_exps_columnar(sql_select, cur, params=()):
+    """
+    Takes an sql query selecting the (stid, start_epoch, end_epoch) columns
+    of certain experiments, and returns them as one numpy structured array
+    (see EXPS_COLUMNS_DTYPE) rather than a list of RawacfRecord objects. 
+    This is a lot lighter for the stats methods, which only need the times.
+
+    [:param params:] [tuple] of values for any '?' placeholders in the query
+
+    :returns: [numpy structured array] with one element per experiment
+    """
+    logging.debug("Querying with the following string:\n%s", sql_select)
+    cur.execute(sql_select, params)
+    return np.array(cur.fetchall(), dtype=EXPS_COLUMNS_DTYPE)
+
 def dump_db(conn):
     """
     Shows all the entries in the DB
@@ -717,20 +932,15 @@ def copy_db_entries(dbfname_src, dbfname_dest):
     #query = "".join(line for line in src_db.iterdump())
     #dest_db.executescript(query)
 
+    # Move the entries over in batches rather than one INSERT per entry
     src_cur.execute('select * from exps')
-    fetches = src_cur.fetchall()
-    for entry_tuple in fetches:
-        try: 
-            logging.debug(entry_tuple)
-            dest_cur.execute('''INSERT INTO exps (stid, start_iso, end_iso, 
-                cmd_name, cmd_args, cpid, min_nave, times_consistent, not_corrupt,
-                min_tfreq, max_tfreq, xcf) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                entry_tuple)
-        except sqlite3.IntegrityError:
-            logging.error("Unique constraint failed or something.")     
-        except sqlite3.OperationalError: 
-            logging.error("\t\tDatabase locked - can't save metadata!")
+    entries = src_cur.fetchmany(COPY_BATCH_SIZE)
+    while entries:
+        if len(entries[0]) != len(EXPS_FIELDS):
+            # Source database predates the epoch columns; work them out
+            entries = [RawacfRecord.record_from_tuple(e).as_tuple() for e in entries]
+        insert_rows(entries, dest_cur)
+        entries = src_cur.fetchmany(COPY_BATCH_SIZE)
     dest_db.commit()
     return src_db, dest_db 
 
@@ -15,6 +15,8 @@ import subprocess
 import os
 
 import time
+from datetime import datetime, timedelta
+import numpy as np
 import rawacf_utils as rut
 import parse
 import uptime
@@ -134,8 +136,8 @@ def test_err_writers():
         file_contents = f.read()
         test_str = "testfile:\"Test Bad Exception\"\ntestfile:Test Inconsistent Exception\n"    
         if file_contents != test_str:
-            print file_contents
-            print test_str
+            print(file_contents)
+            print(test_str)
             logging.error("test_err_writers() failed!")
     os.remove(test_listfile)
 
@@ -167,6 +169,41 @@ def test_exc_handler():
         logging.error("Exception handler seems to be not doing its job!")
     p.terminate()
 
+def test_save_records():
+    """
+    Tests that a save_records() call which fails part-way through leaves the
+    connection usable, so that the rows can still be saved afterwards (as
+    parse_rawacf_folder does when falling back from multiprocessing).
+    """
+    logging.info("Testing recovery from a failed save_records()...")
+    test_dbfile = 'test_save_records.sqlite'
+    conn = rut.connect_db(dbname=test_dbfile)
+    start_dt = rut.iso_to_dt(sample_start_iso)
+    end_dt = rut.iso_to_dt(sample_end_iso)
+    rows = [rut.RawacfRecord(stid, start_dt, end_dt).as_tuple() for stid in range(1, 6)]
+
+    def failing_rows():
+        yield rows[0]
+        raise IOError("Test failure part-way through the rows")
+
+    try:
+        parse.save_records(failing_rows(), conn, bulk_load=True)
+        test1 = False
+    except IOError:
+        # The real error should come through, with the transaction undone
+        test1 = not conn.in_transaction
+    test2 = parse.save_records(iter(rows), conn, bulk_load=True) == len(rows)
+    num_rows = conn.execute('select count(*) from exps').fetchone()[0]
+    sync = conn.execute('PRAGMA synchronous').fetchone()[0]
+    # 1 is 'NORMAL', as connect_db sets it
+    test3 = num_rows == len(rows) and sync == 1
+    conn.close()
+    for f in os.listdir('.'):
+        if f.startswith(test_dbfile):
+            os.remove(f)
+    if not(test1 and test2 and test3):
+        logging.error("Problem with recovering from a failed save_records()!")
+
 # ------------------------------------------------------------------------------
 #                   rawacf_utils.py Tests: Database methods
 # ------------------------------------------------------------------------------
@@ -244,6 +281,49 @@ def test_db():
     if r != []:
         logging.error("Problem with dumping database!")   
 
+def test_insert_rows():
+    """
+    Tests that batches of entries are saved by insert_rows(), including 
+    when some of the entries are already in the database.
+    """
+    logging.info("Testing batch inserts into the database...")
+    conn = rut.connect_db(dbname=TESTDB)
+    cur = conn.cursor()
+    rut.dump_db(conn)
+    start_dt = rut.iso_to_dt(sample_start_iso)
+    end_dt = rut.iso_to_dt(sample_end_iso)
+    rows = [rut.RawacfRecord(stid, start_dt, end_dt).as_tuple() for stid in range(1, 6)]
+    rut.insert_rows(rows[:2], cur)
+    # Should skip the two duplicates and still save the other three
+    rut.insert_rows(rows, cur)
+    conn.commit()
+    r = rut.select_exps('select * from exps', cur)
+    if len(r) != len(rows):
+        logging.error("Problem with batch inserts using insert_rows()!")
+
+    # A batch that fails part-way, here on its last entry (after a bulk 
+    # statement's worth has been written), should leave nothing behind
+    def fail():
+        raise ValueError("Test failure part-way through the batch")
+    conn.create_function('fail', 0, fail)
+    cur.execute("CREATE TEMP TRIGGER fail_insert BEFORE INSERT ON exps "
+                "WHEN NEW.stid = 99 BEGIN SELECT fail(); END")
+    batch = [rut.RawacfRecord(50, start_dt + timedelta(hours=i), end_dt + timedelta(hours=i)).as_tuple()
+             for i in range(rut.ROWS_PER_BULK_INSERT + 1)]
+    batch.append(rut.RawacfRecord(99, start_dt, end_dt).as_tuple())
+    rut.insert_rows(batch, cur)
+    conn.commit()
+    num_left = cur.execute('select count(*) from exps where stid in (50, 99)').fetchone()[0]
+    try:
+        cur.execute('RELEASE insert_rows')
+        savepoint_left = True
+    except sqlite3.OperationalError:
+        savepoint_left = False
+    cur.execute('DROP TRIGGER fail_insert')
+    if num_left != 0 or savepoint_left:
+        logging.error("Problem with undoing a failed batch in insert_rows()!")
+    rut.dump_db(conn)
+
 # ------------------------------------------------------------------------------
 #                   rawacf_utils.py Tests: Utility Methods
 # ------------------------------------------------------------------------------
@@ -255,12 +335,12 @@ def test_check_fields():
     """
     logging.info("Testing the field-checking for dmap entries...")
     objection_dict = rut.check_fields(test_dmap_dicts) 
-    test1 = objection_dict.keys() == []
+    test1 = len(objection_dict) == 0
 
     # Needs to be able to deal with a non-splittable command name without breaking 
     test_dmap_dicts[0]['origin.command'] = "test"
     objection_dict = rut.check_fields(test_dmap_dicts) 
-    test2 = objection_dict.keys() == []
+    test2 = len(objection_dict) == 0
 
     # Needs to detect cpid inconsistency
     tmp = test_dmap_dicts[0]['cp']
@@ -323,6 +403,102 @@ def test_records():
     if type(dur) != float:
         logging.error("Error with duration()")
 
+# ------------------------------------------------------------------------------
+#                       uptime.py Tests: Stats methods
+# ------------------------------------------------------------------------------
+
+def test_stats_cache():
+    """
+    Tests that cached day stats aren't handed out for a different database
+    (e.g. one opened right after the first was closed) or after the data
+    has changed.
+    """
+    logging.info("Testing the day stats cache...")
+    test_dbfiles = ['test_stats_cache_a.sqlite', 'test_stats_cache_b.sqlite']
+    start_dt = rut.iso_to_dt(sample_start_iso)
+    end_dt = rut.iso_to_dt(sample_end_iso)
+    row = rut.RawacfRecord(rut.get_stid('sas'), start_dt, end_dt).as_tuple()
+    year, month, day = start_dt.year, start_dt.month, start_dt.day
+
+    conn = rut.connect_db(dbname=test_dbfiles[0])
+    parse.save_records(iter([row]), conn)
+    conn.close()
+    conn = rut.connect_db(dbname=test_dbfiles[0])
+    test1 = uptime.stats_day(year, month, day, conn.cursor(), 'sas') > 0
+    conn.close()
+    del conn
+
+    # An empty database opened straight after (quite possibly given the same
+    # id() as the last connection) must not get the first one's stats
+    conn = rut.connect_db(dbname=test_dbfiles[1])
+    test2 = uptime.stats_day(year, month, day, conn.cursor(), 'sas') == 0
+    test3 = uptime.stats_month(year, month, conn.cursor(), 'sas')[day-1] == 0
+    parse.save_records(iter([row]), conn)
+    test4 = uptime.stats_day(year, month, day, conn.cursor(), 'sas') > 0
+    conn.close()
+    for f in os.listdir('.'):
+        if any(f.startswith(dbfile) for dbfile in test_dbfiles):
+            os.remove(f)
+    if not(test1 and test2 and test3 and test4):
+        logging.error("Problem with the day stats cache!")
+
+def test_uptime_per_day():
+    """
+    Tests uptime_per_day() on its own: overlapping records (e.g. two channels
+    running at once) mustn't be counted twice, a record crossing midnight
+    counts towards both days, and no records means no uptime.
+    """
+    logging.info("Testing uptime_per_day()...")
+    hr = 3600.
+    day1 = rut.get_epoch_seconds(datetime(2017, 7, 18))
+    # Two channels overlapping from 3:00 to 6:00, then one from 22:00 to 2:00
+    starts = np.array([day1 + 3*hr, day1, day1 + 22*hr])
+    ends = np.array([day1 + 9*hr, day1 + 6*hr, day1 + 26*hr])
+    day_stats = uptime.uptime_per_day(starts, ends, day1, 3)
+    expected = [100*11/24., 100*2/24., 0.]
+    test1 = np.allclose(day_stats, expected)
+    empty = np.array([], dtype=float)
+    test2 = np.allclose(uptime.uptime_per_day(empty, empty, day1, 2), [0., 0.])
+    if not(test1 and test2):
+        logging.error("Problem with uptime_per_day()!")
+
+def test_stats_all_radars():
+    """
+    Tests that stats_month_all_radars() gives each radar the same stats as
+    stats_month() does for that radar alone, including radars without any
+    records that month.
+    """
+    logging.info("Testing stats_month_all_radars()...")
+    test_dbfile = 'test_stats_all_radars.sqlite'
+    conn = rut.connect_db(dbname=test_dbfile)
+    day = datetime(2017, 7, 18)
+    hr = timedelta(hours=1)
+    spans = [('sas', day, day + 6*hr), ('sas', day + 3*hr, day + 9*hr),
+             ('sas', day + 22*hr, day + 26*hr), ('kap', day + 12*hr, day + 18*hr),
+             ('kap', day - 17*24*hr, day - 17*24*hr + 12*hr)]
+    rows = [rut.RawacfRecord(rut.get_stid(code), start, end).as_tuple()
+            for code, start, end in spans]
+    parse.save_records(iter(rows), conn)
+    cur = conn.cursor()
+
+    all_stats = uptime.stats_month_all_radars(day.year, day.month, cur)
+    test1 = True
+    for code in rut.allradars:
+        # (So that stats_month works them out again rather than using the
+        # ones stats_month_all_radars just cached)
+        uptime.day_stats_cache.clear()
+        day_stats = uptime.stats_month(day.year, day.month, cur, code)
+        test1 = test1 and np.allclose(all_stats[code], day_stats)
+    test2 = np.allclose(all_stats['sas'][17:19], [100*11/24., 100*2/24.])
+    test3 = np.allclose(all_stats['kap'][0], 50.) and np.allclose(all_stats['kap'][17], 25.)
+    test4 = sum(all_stats['inv']) == 0
+    conn.close()
+    for f in os.listdir('.'):
+        if f.startswith(test_dbfile):
+            os.remove(f)
+    if not(test1 and test2 and test3 and test4):
+        logging.error("Problem with stats_month_all_radars()!")
+
 if __name__=="__main__":
     rut.read_config()
     rut.globus_connect()
@@ -337,9 +513,14 @@ if __name__=="__main__":
     test_reads()
     test_check_fields() 
     test_db()
+    test_insert_rows()
     test_records() # Requires reads(), fields(), db() to have been tested before.
 
     test_exc_handler()
     test_err_writers()
+    test_save_records()
+    test_stats_cache()
+    test_uptime_per_day()
+    test_stats_all_radars()
 
     #test_process_rawacfs()
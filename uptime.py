@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding: utf-8
 """
 file: 'uptime.py'
@@ -14,18 +14,45 @@ date: June 20 2017
 """
 import logging
 import os
+import sys
 import argparse
 
+from collections import OrderedDict
 from datetime import datetime as dt
 import numpy as np
 import sqlite3
-import calendar
 
 import rawacf_utils as rut
-from rawacf_utils import two_pad
 
 LOG_FILE = 'uptime.log'
 SEC_IN_DAY = 86400.0
+# Most days' % uptimes kept in day_stats_cache (a month of every radar is ~1100)
+DAY_STATS_CACHE_SIZE = 4096
+
+# Longest a record is assumed to last. A rawacf file covers a couple of hours
+# at most (the longest seen are under a day), so this lets the stats queries
+# seek straight to a span's records rather than walk a station's whole history
+MAX_RECORD_SECONDS = SEC_IN_DAY
+
+# A station's records overlapping a span of time. Given as epoch seconds, the
+# parameters after the stid are the span's start less MAX_RECORD_SECONDS, its
+# end, then its start (see overlap_params). Kept as one fixed, parameterized
+# string so sqlite can reuse the compiled statement from call to call
+OVERLAPPING_EXPS_SQL = ("select stid, start_epoch, end_epoch from exps "
+                        "where stid=? and start_epoch >= ? and start_epoch < ? "
+                        "and end_epoch >= ?")
+# The same, for a list of stations at once (the stids' placeholders get 
+# filled in), with each station's records kept together
+ALL_OVERLAPPING_EXPS_SQL = ("select stid, start_epoch, end_epoch from exps "
+                            "where stid in ({0}) and start_epoch >= ? and start_epoch < ? "
+                            "and end_epoch >= ? order by stid")
+
+# % uptimes worked out so far, keyed by (stid, year, month, day). They're only
+# good for the connection and data state they came from, which are kept in
+# day_stats_source (see use_day_stats_cache). The least recently used days
+# get dropped beyond DAY_STATS_CACHE_SIZE
+day_stats_cache = OrderedDict()
+day_stats_source = dict(conn=None, state=None)
 
 # -----------------------------------------------------------------------------
 #                           POST PROCESSING METHODS
@@ -50,12 +77,9 @@ def stats_month_summary(year, month, cur):
     :param
     """
     #TODO: params
-    stats = dict()
+    stats = stats_month_all_radars(year, month, cur)
     averages = dict()
-    radar_codes = rut.allradars.keys()
-    for code in radar_codes:  
-        stats_list = stats_month(year, month, cur, code)
-        stats[code] = stats_list
+    for code, stats_list in stats.items():
         averages[code] = np.mean(stats_list)
     print(averages)
     return stats, averages
@@ -98,72 +122,215 @@ def stats_day(year, month, day, cur, code=None):
     """
     #TODO: params
     assert(year > 2002)
-    assert(month in np.arange(1,13))
-    last_day = calendar.monthrange(year, month)[1]
-    assert(day in np.arange(1,last_day+1))
+    assert(1 <= month <= 12)
+    last_day = rut.days_in_month(year, month)
+    assert(1 <= day <= last_day)
     if code is None:
         logging.warning("No station code given, proceeding with default, Saskatoon ('sas')")
 
-    date_str = str(year) + two_pad(month) + two_pad(day)
-    date_str_iso = str(year) + "-" + two_pad(month) + "-" + two_pad(day)
-
-    uptime_on_day = dict()
-
     stid = rut.get_stid(code)
-    sql = "select * from exps where (start_iso like '%{0}%' or end_iso like '%{1}%') and stid='{2}'"
-    recs = rut.select_exps(sql.format(date_str_iso, date_str_iso, stid), cur)
-
-    for r in recs:
-        logging.debug("Looking at record from {0} to {1}".format(r.start_dt, r.end_dt))
-        st = r.start_dt
-        et = r.end_dt
-        if rut.get_datestr(st) != rut.get_datestr(et):
-            logging.debug("\tStart date not the same as end date?")
-            if date_str == rut.get_datestr(st):
-                logging.debug("\tSpecial case: end-of-day record")
-                seconds_this_day = SEC_IN_DAY - rut.get_tod_seconds(st)
-            elif date_str == rut.get_datestr(et):
-                logging.debug("\tSpecial case: start-of-day record")
-                seconds_prev_day = SEC_IN_DAY - rut.get_tod_seconds(st)
-                seconds_this_day = r.duration() - seconds_prev_day                
-            else: 
-                # This shouldn't ever happen
-                raise Exception('Unexpected start date and end date discrepancies?')
-        else:
-            seconds_this_day = r.duration()
-        logging.debug("Seconds of operation for this record: {0}\n".format(seconds_this_day)) 
-        uptime_on_day[r] = seconds_this_day 
-    
-    uptime_pct = sum(uptime_on_day.values())/SEC_IN_DAY * 100.
+    use_day_stats_cache(cur)
+    cache_key = (stid, year, month, day)
+    if cache_key in day_stats_cache:
+        day_stats_cache.move_to_end(cache_key)
+        return day_stats_cache[cache_key]
+
+    day_start = dt(year, month, day)
+
+    # Records overlapping the day, found by an index range scan. Only their
+    # times are needed, so they're fetched as numpy columns, not records
+    day_start_ep = rut.get_epoch_seconds(day_start)
+    params = (stid,) + overlap_params(day_start_ep, 1)
+    exps = rut.select_exps_columnar(OVERLAPPING_EXPS_SQL, cur, params)
+    logging.debug("Found %d records overlapping %s", len(exps), day_start.date())
+
+    uptime_pct = uptime_per_day(exps['start'], exps['end'], day_start_ep, 1)[0]
+    cache_day_stats(cache_key, uptime_pct)
     return uptime_pct
 
 def stats_month(year, month, cur, code=None):
     """
-    Calculates uptime stats for the entire month 
+    Calculates uptime stats for the entire month, giving the % uptime for
+    each day. The month's records are fetched with a single query and 
+    split up between the days all at once with numpy.
     """
     if code is None:
         logging.warning("No station code given, proceeding with default, Saskatoon ('sas')")
 
-    last_day = calendar.monthrange(year, month)[1]
-    days = np.arange(1, last_day + 1)
-    day_stats = []
-    for day in days:
-        day_stats.append(stats_day(year, month, day, cur, code)) 
-    #print("{0}: {1} % Uptime".format(code, np.mean(day_stats)))
-    return day_stats
+    last_day = rut.days_in_month(year, month)
+    month_start = dt(year, month, 1)
+
+    stid = rut.get_stid(code)
+    use_day_stats_cache(cur)
+    cached = cached_month_stats(stid, year, month)
+    if cached is not None:
+        return cached
+
+    month_start_ep = rut.get_epoch_seconds(month_start)
+    params = (stid,) + overlap_params(month_start_ep, last_day)
+    exps = rut.select_exps_columnar(OVERLAPPING_EXPS_SQL, cur, params)
+
+    day_stats = uptime_per_day(exps['start'], exps['end'], month_start_ep, last_day)
+    # Remember each day's result for later stats_day/stats_month calls
+    for day, uptime_pct in enumerate(day_stats, 1):
+        cache_day_stats((stid, year, month, day), uptime_pct)
+    return day_stats.tolist()
+
+def stats_month_all_radars(year, month, cur):
+    """
+    Calculates uptime stats for the entire month for every radar at once. 
+    All the radars' records are fetched with a single query (sorted by 
+    station) and then split up between the radars and days with numpy.
+
+    :param year: [int] indicating the year to look at
+    :param month: [int] indicating the month to look at
+    :param cur: [sqlite3 cursor] into the database
+
+    :returns: [dict] of lists of each day's % uptime, keyed by station code
+    """
+    use_day_stats_cache(cur)
+    stats = dict()
+    for code, stid in rut.allradars.items():
+        stats[code] = cached_month_stats(stid, year, month)
+    if all(day_stats is not None for day_stats in stats.values()):
+        return stats
+
+    last_day = rut.days_in_month(year, month)
+    month_start_ep = rut.get_epoch_seconds(dt(year, month, 1))
+    stids = sorted(set(rut.allradars.values()))
+    # 'stid in (...)' still lets sqlite seek the index, one station at a time
+    sql = ALL_OVERLAPPING_EXPS_SQL.format(','.join('?'*len(stids)))
+    params = tuple(stids) + overlap_params(month_start_ep, last_day)
+    exps = rut.select_exps_columnar(sql, cur, params)
+
+    for code, stid in rut.allradars.items():
+        # The rows come grouped by station, so each one's are a contiguous slice
+        lo, hi = np.searchsorted(exps['stid'], [stid, stid + 1])
+        day_stats = uptime_per_day(exps['start'][lo:hi], exps['end'][lo:hi],
+                                   month_start_ep, last_day)
+        for day, uptime_pct in enumerate(day_stats, 1):
+            cache_day_stats((stid, year, month, day), uptime_pct)
+        stats[code] = day_stats.tolist()
+    return stats
+
+def cached_month_stats(stid, year, month):
+    """
+    Looks up a station's month of % uptimes in day_stats_cache.
+
+    :param stid: [int] the station ID
+    :param year: [int] indicating the year to look at
+    :param month: [int] indicating the month to look at
+
+    :returns: [list] of each day's % uptime, or None if any day isn't cached
+    """
+    last_day = rut.days_in_month(year, month)
+    keys = [(stid, year, month, day) for day in range(1, last_day+1)]
+    if not all(key in day_stats_cache for key in keys):
+        return None
+    for key in keys:
+        day_stats_cache.move_to_end(key)
+    return [float(day_stats_cache[key]) for key in keys]
+
+def cache_day_stats(key, uptime_pct):
+    """
+    Adds a day's % uptime to day_stats_cache, dropping the least recently
+    used days if that takes it over DAY_STATS_CACHE_SIZE.
+
+    :param key: [tuple] of (stid, year, month, day)
+    :param uptime_pct: [float] the day's % uptime
+    """
+    day_stats_cache[key] = uptime_pct
+    day_stats_cache.move_to_end(key)
+    while len(day_stats_cache) > DAY_STATS_CACHE_SIZE:
+        day_stats_cache.popitem(last=False)
+
+def overlap_params(first_day, num_days):
+    """
+    Gives the time parameters of OVERLAPPING_EXPS_SQL/ALL_OVERLAPPING_EXPS_SQL
+    for a run of consecutive days.
+
+    :param first_day: [float] epoch seconds at the start of the first day
+    :param num_days: [int] how many days the span covers
+
+    :returns: [tuple] of the lowest start time searched, the span's end, and
+                the span's start
+    """
+    span_end = first_day + num_days*SEC_IN_DAY
+    return (first_day - MAX_RECORD_SECONDS, span_end, first_day)
+
+def use_day_stats_cache(cur):
+    """
+    Empties day_stats_cache if it was filled through a different connection
+    than cur's, or before the data seen through cur last changed.
+
+    The connection itself is held onto (sqlite3 connections can't be weakly
+    referenced) rather than its id(), since a closed connection's id() can
+    be handed straight to a new one on another database.
+
+    :param cur: [sqlite3 cursor] into the database
+    """
+    conn = cur.connection
+    state = db_state(cur)
+    if conn is not day_stats_source['conn'] or state != day_stats_source['state']:
+        day_stats_cache.clear()
+        day_stats_source.update(conn=conn, state=state)
+
+def db_state(cur):
+    """
+    Identifies the state of the data seen through a connection, so that
+    cached stats can be told apart from ones computed before the data 
+    changed (by this connection or by anyone else). Only comparable between
+    calls on the same connection.
+
+    :param cur: [sqlite3 cursor] into the database
+
+    :returns: [tuple] that changes whenever the data seen through cur does
+    """
+    conn = cur.connection
+    data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+    return (data_version, conn.total_changes)
+
+def uptime_per_day(starts, ends, first_day, num_days):
+    """
+    Computes the % uptime on each of a run of consecutive days, by clipping
+    every record to every day's bounds in one go. Overlapping records (e.g.
+    from multiple channels) are merged so that no time is counted twice.
+
+    :param starts: [numpy array] of record start times in epoch seconds
+    :param ends: [numpy array] of record end times in epoch seconds
+    :param first_day: [float] epoch seconds at the start of the first day
+    :param num_days: [int] how many days to compute uptime for
+
+    :returns: [numpy array] of the % uptime on each day
+    """
+    day_starts = first_day + SEC_IN_DAY*np.arange(num_days)
+    day_ends = day_starts + SEC_IN_DAY
+    order = np.argsort(starts, kind='mergesort')
+    # (records x days) arrays of each record's start and end, clipped to
+    # each day (clipping keeps the records sorted by start time)
+    clipped_starts = np.clip(starts[order, None], day_starts, day_ends)
+    clipped_ends = np.clip(ends[order, None], day_starts, day_ends)
+    # Sweep through the records: the furthest point already covered by the
+    # records before each one is the running maximum of their end times
+    covered = np.maximum.accumulate(clipped_ends, axis=0)
+    covered = np.vstack((day_starts[None, :], covered[:-1]))
+    new_seconds = clipped_ends - np.maximum(clipped_starts, covered)
+    seconds = np.clip(new_seconds, 0., None).sum(axis=0)
+    return seconds/SEC_IN_DAY * 100.
 
 def stats_summary(cur):
     """
     Informational overview of timespan of entries in DB
     """
-    sql = "select * from exps"
-    recs = rut.select_exps(sql, cur)
-    if type(recs)!=list or len(recs)==0:
+    # Let sqlite find the earliest and latest (ISO strings sort by time)
+    # rather than fetching every entry
+    sql = "select min(start_iso), max(start_iso) from exps"
+    first_iso, last_iso = cur.execute(sql).fetchone()
+    if first_iso is None:
         logging.warning("No entries in database!")
     else:
-        times = [ r.start_dt for r in recs ]
-        first = min(times)
-        last = max(times)
+        first = rut.iso_to_dt(first_iso)
+        last = rut.iso_to_dt(last_iso)
         print("Entries in database span {0} through {1}".format(first, last))
     return None
 
@@ -176,7 +343,6 @@ def update_progress(progress):
 
     Code by Brian Khuu
     """
-    import time, sys
     barLength = 10 # Modify this to change the length of the progress bar
     status = ""
     if isinstance(progress, int):
@@ -247,20 +413,28 @@ def process_args(year, month, day, st_code, use_verbose, cur):
         logging.info("Verbosity set medium!")
         initialize_logger(use_verbose)
 
-    if day is not None:
-        if st_code is not None:
-            stats = stats_day(year, month, day, cur, st_code)
+    # All the queries share one read transaction, so they see a single 
+    # snapshot of the database and don't each start and end their own
+    conn = cur.connection
+    if not conn.in_transaction:
+        cur.execute('BEGIN')
+    try:
+        if day is not None:
+            if st_code is not None:
+                stats = stats_day(year, month, day, cur, st_code)
+            else:
+                stats = do_forall_radars(stats_day, (year, month, day, cur))
+#                stats = stats_day_summary(year, month, day, cur)
+        elif month is not None:
+            if st_code is not None:
+                stats = stats_month(year, month, cur, st_code)
+            else:
+                stats = stats_month_all_radars(year, month, cur)
+#                stats = stats_month_summary(year, month, cur)
         else:
-            stats = do_forall_radars(stats_day, (year, month, day, cur))
-#            stats = stats_day_summary(year, month, day, cur)
-    elif month is not None:
-        if st_code is not None:
-            stats = stats_month(year, month, cur, st_code)
-        else:
-            stats = do_forall_radars(stats_month, (year, month, cur))
-#            stats = stats_month_summary(year, month, cur)
-    else:
-        stats = stats_summary(cur)
+            stats = stats_summary(cur)
+    finally:
+        conn.commit()
     return stats
 
 def initialize_logger(use_verbose):